@@ -0,0 +1,281 @@
+import os
+import asyncio
+import shutil
+import time
+import uuid
+import hashlib
+
+
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local")
+CACHE_DIR = os.environ.get("CACHE_DIR", "/tmp/openwatcherhub-cache")
+
+CACHE_S3_ENDPOINT = os.environ.get("CACHE_S3_ENDPOINT", None)
+CACHE_S3_BUCKET = os.environ.get("CACHE_S3_BUCKET", "openwatcherhub")
+CACHE_S3_PREFIX = os.environ.get("CACHE_S3_PREFIX", "")
+CACHE_S3_REGION = os.environ.get("CACHE_S3_REGION", "us-east-1")
+CACHE_S3_ACCESS_KEY = os.environ.get("CACHE_S3_ACCESS_KEY", None)
+CACHE_S3_SECRET_KEY = os.environ.get("CACHE_S3_SECRET_KEY", None)
+
+# a claim older than this is considered abandoned (worker died mid-render)
+CLAIM_TTL = float(os.environ.get("CACHE_CLAIM_TTL", 600))
+CLAIM_POLL = float(os.environ.get("CACHE_CLAIM_POLL", 0.5))
+
+CLAIM_SUFFIX = ".claim"
+
+# entries unused for this long are evicted, 0 keeps everything
+CACHE_MAX_AGE = float(os.environ.get("CACHE_MAX_AGE_HOURS", 168)) * 3600
+CACHE_EVICT_INTERVAL = float(os.environ.get("CACHE_EVICT_INTERVAL", 3600))
+
+WORKER_ID = f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class CacheBackend:
+    """Shared storage for band data and rendered outputs.
+
+    Keys are slash separated relative paths, e.g. "bands/<product>/B04.jp2".
+    Every API/render worker pointing at the same backend sees the same entries,
+    and claims let one worker produce an entry while the others wait for it.
+    """
+
+    def fetch(self, key: str, dest: str) -> str | None:
+        """Return a local path holding `key`, or None if it is not cached."""
+        raise NotImplementedError
+
+    def put(self, key: str, src: str):
+        raise NotImplementedError
+
+    def claim(self, key: str) -> bool:
+        """Try to become the producer of `key`. Returns False if another worker holds it."""
+        raise NotImplementedError
+
+    def release(self, key: str):
+        raise NotImplementedError
+
+    def evict(self, max_age: float) -> int:
+        """Remove entries older than `max_age` seconds. Returns how many were removed."""
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """Cache in a local directory, shared between nodes when that directory is an NFS mount."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def fetch(self, key, dest):
+        path = self._path(key)
+        # files on the shared directory can be read in place, no need to copy
+        if not os.path.exists(path):
+            return None
+        try:
+            # eviction goes by last use
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, src):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{WORKER_ID}.tmp"
+        shutil.copyfile(src, tmp)
+        # atomic on the same filesystem, readers never see half written files
+        os.replace(tmp, path)
+
+    def claim(self, key):
+        path = self._path(key) + CLAIM_SUFFIX
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < CLAIM_TTL:
+                        return False
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(WORKER_ID)
+            return True
+        return False
+
+    def release(self, key):
+        try:
+            os.remove(self._path(key) + CLAIM_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def evict(self, max_age):
+        cutoff = time.time() - max_age
+        removed = 0
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        # readers that already opened the file keep their handle
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    # another worker evicted it first
+                    pass
+        return removed
+
+
+class S3Cache(CacheBackend):
+    """Cache in an S3 compatible bucket (AWS, MinIO, Ceph...)."""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint: str = None, region: str = None,
+                 access_key: str = None, secret_key: str = None):
+        import boto3
+        from botocore.exceptions import ClientError
+
+        self.ClientError = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+        try:
+            self.client.head_bucket(Bucket=bucket)
+        except ClientError:
+            # fresh MinIO stand-ins start without buckets
+            self.client.create_bucket(Bucket=bucket)
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _missing(self, err) -> bool:
+        return err.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound")
+
+    def fetch(self, key, dest):
+        try:
+            self.client.download_file(self.bucket, self._key(key), dest)
+        except self.ClientError as err:
+            if self._missing(err):
+                return None
+            raise
+        return dest
+
+    def put(self, key, src):
+        self.client.upload_file(src, self.bucket, self._key(key))
+
+    def claim(self, key):
+        claim_key = self._key(key) + CLAIM_SUFFIX
+        for _ in range(2):
+            try:
+                # conditional write, only one worker can create the claim object
+                self.client.put_object(Bucket=self.bucket, Key=claim_key, Body=WORKER_ID.encode(), IfNoneMatch="*")
+                return True
+            except self.ClientError as err:
+                if err.response["Error"]["Code"] not in ("PreconditionFailed", "412", "ConditionalRequestConflict"):
+                    raise
+            try:
+                head = self.client.head_object(Bucket=self.bucket, Key=claim_key)
+            except self.ClientError as err:
+                if self._missing(err):
+                    continue
+                raise
+            if time.time() - head["LastModified"].timestamp() < CLAIM_TTL:
+                return False
+            self.client.delete_object(Bucket=self.bucket, Key=claim_key)
+        return False
+
+    def release(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key) + CLAIM_SUFFIX)
+
+    def evict(self, max_age):
+        # S3 keeps no access time, entries age from when they were written
+        cutoff = time.time() - max_age
+        removed = 0
+        pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix)
+        for page in pages:
+            old = [{"Key": obj["Key"]} for obj in page.get("Contents", []) if obj["LastModified"].timestamp() < cutoff]
+            if old:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": old, "Quiet": True})
+                removed += len(old)
+        return removed
+
+
+async def cached_file(cache: CacheBackend, key: str, dest: str, produce, run=None) -> str:
+    """Return a local path to `key`, calling `produce(dest)` only if no worker has made it yet.
+
+    If another worker has claimed the key we wait for its result instead of
+    recomputing it, until the claim goes stale. Waiting holds no thread, only
+    `produce` runs on `run` (an async fn(fn, *args), the default executor if None).
+    """
+    loop = asyncio.get_event_loop()
+
+    def io(fn, *args):
+        return loop.run_in_executor(None, fn, *args)
+
+    run = run or io
+    deadline = time.time() + CLAIM_TTL
+    while True:
+        path = await io(cache.fetch, key, dest)
+        if path:
+            return path
+        if await io(cache.claim, key):
+            try:
+                # someone may have finished between our fetch and claim
+                path = await io(cache.fetch, key, dest)
+                if path:
+                    return path
+                await run(produce, dest)
+                await io(cache.put, key, dest)
+            finally:
+                await io(cache.release, key)
+            return dest
+        if time.time() > deadline:
+            await run(produce, dest)
+            return dest
+        await asyncio.sleep(CLAIM_POLL)
+
+
+async def evict_periodically():
+    """Evict old entries every CACHE_EVICT_INTERVAL seconds, for as long as the worker runs."""
+    if not CACHE_MAX_AGE:
+        return
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            removed = await loop.run_in_executor(None, get_cache().evict, CACHE_MAX_AGE)
+            print("cache eviction removed", removed, "entries")
+        except Exception as err:
+            print("cache eviction failed:", repr(err))
+        await asyncio.sleep(CACHE_EVICT_INTERVAL)
+
+
+def request_key(payload: str) -> str:
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+_cache = None
+
+def get_cache() -> CacheBackend:
+    global _cache
+    if _cache is None:
+        if CACHE_BACKEND == "s3":
+            _cache = S3Cache(
+                CACHE_S3_BUCKET,
+                prefix=CACHE_S3_PREFIX,
+                endpoint=CACHE_S3_ENDPOINT,
+                region=CACHE_S3_REGION,
+                access_key=CACHE_S3_ACCESS_KEY,
+                secret_key=CACHE_S3_SECRET_KEY,
+            )
+        elif CACHE_BACKEND == "local":
+            _cache = LocalCache(CACHE_DIR)
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND {CACHE_BACKEND}")
+    return _cache
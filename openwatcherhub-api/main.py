@@ -1,6 +1,12 @@
+import warmup
+
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import asyncio
+import contextlib
+import time
+import traceback
 
 import os
 #os.environ["PROJ_DEBUG"] = "2"
@@ -15,29 +21,63 @@ logger.addHandler(console_handler)
 #logger.setLevel(logging.DEBUG)
 
 import tempfile
+import shutil
 import json
 
+# only light modules here, rasterio/numpy and the pipeline are loaded by the warm up
 from models import ProcessRequest
-from search import search
-from evalscript import compile
+from cache import request_key, evict_periodically
+
+# per-request scratch space, everything worth keeping goes to the shared cache
+WORK_DIR = os.environ.get("WORK_DIR", None)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # warm up in the background, /ready reports 503 until it is done
+    warmup.start()
+    evicting = asyncio.create_task(evict_periodically())
+    yield
+    evicting.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
-from process import format_setup, download, render, ProcessContext
 
-from products import SUPPORTED_PRODUCTS
+@app.get("/health")
+async def health():
+    return warmup.state.report()
 
-app = FastAPI()
 
+@app.get("/ready")
+async def ready():
+    return JSONResponse(warmup.state.report(), status_code=200 if warmup.state.status == "ready" else 503)
 
 
 @app.post("/api/v1/process")
-async def process(req: ProcessRequest):
-    ctx = ProcessContext(req)
+async def process(req: ProcessRequest, stream: bool = False):
+    started = time.time()
+    await warmup.wait_ready()
+    from search import search, TooManyResults
+    from evalscript import compile
+    from process import format_setup, estimate_pixels, ProcessContext, TileRenderer, StreamedOutput, write_tiles, streamable, MOSAIC_MAX_SCENES
+    from products import SUPPORTED_PRODUCTS
+    from scheduler import get_scheduler
+    from cache import get_cache
+
+    from rasterio.errors import CRSError
+
+    try:
+        ctx = ProcessContext(req)
+    except CRSError as err:
+        raise HTTPException(status_code=422, detail=f"Unsupported crs: {err}")
 
     product_type = req.input.data[0].type
     if product_type not in SUPPORTED_PRODUCTS:
         raise HTTPException(status_code=422, detail=f"{product_type} is not supported.")
     
     ctx.product = SUPPORTED_PRODUCTS[product_type]
+    if ctx.product["odata"]["timeRange"] and req.input.data[0].dataFilter.timeRange is None:
+        raise HTTPException(status_code=422, detail=f"{product_type} needs a dataFilter.timeRange.")
 
     vectorized_evalscript = False
     if "VECTORIZE" in req.evalscript:
@@ -48,17 +88,95 @@ async def process(req: ProcessRequest):
     setup = script["setup"]()
     ctx.setup = format_setup(setup)
     
-    res = search(ctx)
-    #print(json.dumps(res, indent=2))
-
-    best = res[0]
-    for r in res:
-        print("cloud cover", [attr['Value'] for attr in r["Attributes"] if attr["Name"] == "cloudCover"][0])
-    ctx.temp_dir = tempfile.mkdtemp()
-    ctx.evaluatePixelFunction = script.get("evaluatePixel", None)
-    # download the bands for all of these
-    await download(ctx, best)
-
-    await render(ctx, vectorized_evalscript)
-    #rerender(ctx)
-    return FileResponse(ctx.temp_dir + "/" + "output.tiff")
+    ctx.temp_dir = tempfile.mkdtemp(dir=WORK_DIR)
+    cleanup = BackgroundTask(shutil.rmtree, ctx.temp_dir, ignore_errors=True)
+
+    # a returned response owns the scratch dir and removes it once sent, failures remove it here
+    try:
+        try:
+            res = search(ctx)
+        except TooManyResults as err:
+            raise HTTPException(status_code=422, detail=str(err))
+        #print(json.dumps(res, indent=2))
+
+        if not res:
+            raise HTTPException(status_code=404, detail="No products found for the request.")
+        if ctx.product["odata"]["cloudCover"]:
+            for r in res:
+                print("cloud cover", [attr['Value'] for attr in r["Attributes"] if attr["Name"] == "cloudCover"][0])
+        # leastCC fills cloudy pixels of the best scene from the next ones, when the product has a cloud mask
+        scenes = res[:1]
+        if ctx.product.get("mosaicTiles", False):
+            # tiles do not overlap, pixels missing in one come from the others
+            scenes = res
+        elif req.input.data[0].dataFilter.mosaickingOrder == "leastCC" and ctx.product.get("cloudMask", None):
+            # scenes without a cloud mask can not tell which of their pixels are clear
+            available = ctx.product.get("cloudMaskAvailable", lambda product_instance: True)
+            if available(res[0]):
+                scenes = [r for r in res if available(r)][:MOSAIC_MAX_SCENES]
+        ctx.evaluatePixelFunction = script.get("evaluatePixel", None)
+
+        # identical requests over the same scenes are answered from the shared render cache by any worker,
+        # new scenes for an open ended time range make a new key
+        cache = get_cache()
+        loop = asyncio.get_event_loop()
+        scene_names = ",".join(scene["Name"] for scene in scenes)
+        output_key = f"renders/{request_key(req.model_dump_json() + scene_names)}.tiff"
+        output_loc = ctx.temp_dir + "/" + "output.tiff"
+        cached = await loop.run_in_executor(None, cache.fetch, output_key, output_loc)
+        if cached:
+            warmup.record_request(started)
+            return FileResponse(cached, background=cleanup)
+
+        renderer = TileRenderer(ctx, scenes, vectorized_evalscript)
+        # a cache cold download must not hold up renders that are served from the cache
+        await renderer.fetch()
+
+        async with contextlib.AsyncExitStack() as stack:
+            # bounded number of heavy renders, each with its share of threads and memory
+            ctx.resources = await stack.enter_async_context(
+                get_scheduler().render_slot(estimate_pixels(req), len(ctx.setup["input"]["bands"]))
+            )
+            stack.push_async_callback(renderer.close)
+            await renderer.prepare()
+
+            if stream and streamable(ctx, renderer):
+                # the render slot and open scenes now belong to a background render, tiles go out as they are written
+                held = stack.pop_all()
+                output = StreamedOutput(ctx, renderer, output_loc)
+
+                async def produce():
+                    try:
+                        async with held:
+                            await output.render()
+                    except Exception:
+                        # the client sees a truncated stream
+                        traceback.print_exc()
+                        return
+                    await loop.run_in_executor(None, cache.put, output_key, output_loc)
+                    warmup.record_request(started)
+
+                rendering = asyncio.create_task(produce())
+
+                async def body():
+                    try:
+                        async for chunk in output.chunks():
+                            yield chunk
+                    finally:
+                        if not output.finished:
+                            # client went away mid render, stop rendering for nobody
+                            rendering.cancel()
+                        # otherwise the output is still being stored in the cache, the scratch dir
+                        # is removed only after the response is done
+                        with contextlib.suppress(asyncio.CancelledError):
+                            await rendering
+
+                return StreamingResponse(body(), media_type="image/tiff", background=cleanup)
+            await write_tiles(ctx, renderer)
+        #rerender(ctx)
+        await loop.run_in_executor(None, cache.put, output_key, output_loc)
+        warmup.record_request(started)
+        return FileResponse(output_loc, background=cleanup)
+    except BaseException:
+        shutil.rmtree(ctx.temp_dir, ignore_errors=True)
+        raise
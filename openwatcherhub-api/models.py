@@ -1,28 +1,56 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator, field_validator
 import typing
+import re
+
+# opengis.net CRS urls, CRS84 or an EPSG code
+CRS_URL_RE = re.compile(r".*(/CRS84|/EPSG/0/\d+)/?$")
+
+class ProcessRequestInputBoundsProperties(BaseModel):
+    crs: str = "http://www.opengis.net/def/crs/OGC/1.3/CRS84"
+
+    @field_validator("crs")
+    @classmethod
+    def check_crs(cls, crs):
+        if not CRS_URL_RE.match(crs):
+            raise ValueError("crs must be an opengis.net CRS84 or EPSG url, e.g. http://www.opengis.net/def/crs/EPSG/0/32633")
+        return crs
 
 class ProcessRequestInputBounds(BaseModel):
-    bbox: typing.List[float]
+    bbox: typing.Optional[typing.List[float]] = None
+    geometry: typing.Optional[dict] = None
+    properties: ProcessRequestInputBoundsProperties = None
+
+    @model_validator(mode="after")
+    def check_area(self):
+        if self.bbox is None and self.geometry is None:
+            raise ValueError("bounds need a bbox or a geometry")
+        if self.bbox is not None and len(self.bbox) != 4:
+            raise ValueError("bbox needs 4 coordinates")
+        if self.geometry is not None and self.geometry.get("type") not in ("Polygon", "MultiPolygon"):
+            raise ValueError("only Polygon and MultiPolygon geometries are supported")
+        return self
 
 class TimeRange(BaseModel):
     from_: str = Field(..., alias='from')
     to: str
 
 class GenericDataFilter(BaseModel):
-    timeRange: TimeRange
+    # required by collections that search by time, see the product "odata" flags
+    timeRange: typing.Optional[TimeRange] = None
     mosaickingOrder: str = "mostRecent"
     maxCloudCoverage: float = 100
     previewMode: str = "DETAIL"
 
 class GenericProcessing(BaseModel):
-    upsampling: str = "NEAREST"
-    downsampling: str = "NEAREST"
+    upsampling: typing.Literal["NEAREST", "BILINEAR", "BICUBIC"] = "NEAREST"
+    downsampling: typing.Literal["NEAREST", "BILINEAR", "BICUBIC", "AVERAGE"] = "NEAREST"
     harmonizeValues: bool = True
+    backCoeff: typing.Literal["BETA0", "SIGMA0_ELLIPSOID", "GAMMA0_ELLIPSOID"] = "GAMMA0_ELLIPSOID"
 
 class ProcessRequestInputData(BaseModel):
     type: str
     id: str = ""
-    dataFilter: GenericDataFilter
+    dataFilter: GenericDataFilter = Field(default_factory=GenericDataFilter)
     processing: GenericProcessing = None
 
 class ProcessRequestInput(BaseModel):
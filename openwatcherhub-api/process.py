@@ -1,26 +1,36 @@
 import typing
 
 import asyncio
-import requests
-import re
 import rasterio
-import rasterio.mask
-from rasterio.io import MemoryFile
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio import windows, features
+from rasterio.transform import from_bounds
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds, Resampling
+from rasterio.crs import CRS
+from affine import Affine
 import numpy as np
-import geopandas as gpd
 import os
-from shapely.geometry import box
 import time
 
 
 import subprocess
 
+from cache import get_cache, cached_file
+from models import GenericProcessing
+from scheduler import get_scheduler, Allocation
+from tiff import TiledTiffStream
+
 class ProcessContext:
     def __init__(self, req):
         self.request = req
         self.setup = {}
         self.product = None
+        self.product_name = ""
+        self.folder = ""
+        self.band_granules = {}
+        self.band_files = {}
+        self.resources = Allocation(1, 64)
+        self.crs = request_crs(req)
+        self.grid = None
         self.evaluatePixelFunction = None
         self.temp_dir = ""
 
@@ -32,15 +42,38 @@ sample_type_to_dtype = {
 
 
 def download_file(url: str, dest: str):
-    subprocess.run(["curl", url, "-o", dest])
+    # fail on http errors, an error page in the shared cache would poison every worker
+    subprocess.run(["curl", "-f", "-s", url, "-o", dest], check=True)
 
 BASE_URL = os.environ.get("S3_PROXY_URL", "http://127.0.0.1")
-IMAGE_FILE_RE = re.compile("<IMAGE_FILE>(.*)</IMAGE_FILE>")
-FILE_EXT = ".jp2"
 
 GTIFF_DRIVER = "Gtiff"
 DEST_CRS = 'EPSG:4326'
 
+# output is rendered in square blocks, blocks outside the area of interest are skipped entirely
+BLOCK_SIZE = int(os.environ.get("BLOCK_SIZE", 512))
+if BLOCK_SIZE <= 0 or BLOCK_SIZE % 16:
+    # blocks are also the tiff tiles, which have to be multiples of 16
+    raise ValueError(f"BLOCK_SIZE must be a positive multiple of 16, got {BLOCK_SIZE}")
+
+
+def request_crs(req) -> str:
+    """CRS of the request bounds and output, from an opengis.net CRS url."""
+    properties = req.input.bounds.properties
+    if properties is None or properties.crs.endswith("CRS84"):
+        return DEST_CRS
+    crs = "EPSG:" + properties.crs.rstrip("/").split("/")[-1]
+    # unknown codes fail here instead of deep in the warper
+    CRS.from_user_input(crs)
+    return crs
+
+
+def request_bounds(req):
+    """Bounding box of the request in its CRS, from the bbox or the geometry."""
+    if req.input.bounds.bbox:
+        return tuple(req.input.bounds.bbox)
+    return features.bounds(req.input.bounds.geometry)
+
 
 def format_setup(setup):
     # format input
@@ -72,23 +105,38 @@ def format_setup(setup):
     return setup
 
 
-async def download(ctx: ProcessContext, product_instance):
-    bands = ctx.setup["input"]["bands"]
+async def download(ctx: ProcessContext, product_instance, bands):
     folder = BASE_URL + product_instance["S3Path"] + "/"
-    url = folder + ctx.product["granules"]["granuleFile"]
-    print(url)
-    def_file = requests.get(url).text
-    granules = IMAGE_FILE_RE.findall(def_file)
-    matched_granules = ctx.product["granules"]["matching"](bands, granules)
+    granules = ctx.product["granules"]["list"](folder, product_instance)
+    band_defs = ctx.product["bands"]
+    matched_granules = ctx.product["granules"]["matching"]([band for band in bands if "derive" not in band_defs[band]], granules)
+    # derived bands (cloud masks etc) are computed from another asset of the product
+    for band in bands:
+        if "derive" in band_defs[band]:
+            asset = band_defs[band]["derive"]["asset"](granules, product_instance)
+            if asset:
+                matched_granules[band] = asset
+    missing = [band for band in bands if band not in matched_granules]
+    if missing:
+        raise ValueError(f"Could not find bands {missing} in {product_instance['Name']}")
+
+    ctx.product_name = product_instance["Name"]
+    ctx.folder = folder
+    ctx.band_granules = matched_granules
+    cache = get_cache()
 
-    loop = asyncio.get_event_loop()
     tasks = []
-    for band in bands:
-        granule = [gran for gran in matched_granules if f"_{band}" in gran][0]
-        url = folder + granule + FILE_EXT
-        tasks.append(loop.run_in_executor(None, download_file, url, f"{ctx.temp_dir}/{band}{FILE_EXT}"))
-    
-    await asyncio.gather(*tasks)
+    # several bands may share an asset (SCL for CLM/CLP), fetch each once
+    unique_granules = list(dict.fromkeys(matched_granules[band] for band in bands))
+    for granule in unique_granules:
+        url = folder + granule
+        name = os.path.basename(granule)
+        key = f"bands/{ctx.product_name}/{name}"
+        dest = f"{ctx.temp_dir}/{name}"
+        tasks.append(cached_file(cache, key, dest, lambda dest, url=url: download_file(url, dest)))
+
+    paths = dict(zip(unique_granules, await asyncio.gather(*tasks)))
+    ctx.band_files = {band: paths[matched_granules[band]] for band in bands}
 
 
 class PixelProcessor:
@@ -102,138 +150,605 @@ class PixelProcessor:
         return self.pixelFn(self.sample)
 
 
-def _get_features(gdf):
-    """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
-    import json
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
-
-
-def rerender_band(ctx, band, band_idx):
-    with rasterio.Env(GDAL_NUM_THREADS=32):
-        points = ctx.request.input.bounds.bbox
-        bbox = box(points[0], points[1], points[2], points[3])
-        geo = gpd.GeoDataFrame({'geometry': bbox}, index=[0])
-        geo.crs = DEST_CRS
-
-        src = rasterio.open(ctx.temp_dir + "/" + band + FILE_EXT, driver='JP2OpenJPEG')
-        band_output_loc = ctx.temp_dir + "/" + band + "_projmask.tiff"
-
-        # project to WSG84
-        unproj = src
-        transform, new_width, new_height = calculate_default_transform(
-            unproj.crs, DEST_CRS, unproj.width, unproj.height, *unproj.bounds)
-        kwargs = unproj.meta.copy()
-        kwargs.update({
-            'crs': DEST_CRS,
-            'transform': transform,
-            'width': new_width,
-            'height': new_height,
-            'count': 1,
-            'dtype': np.float32,
-            'driver': GTIFF_DRIVER
-        })
-
-        with MemoryFile() as proj_band:
-            band_shp = (new_height, new_width)
-            with proj_band.open(**kwargs) as band_dst:
-                dest = np.zeros(band_shp)
+def _processing(ctx) -> GenericProcessing:
+    return ctx.request.input.data[0].processing or GenericProcessing()
+
+
+def _nodata(band_def, src):
+    return band_def["nodata"] if band_def["nodata"] is not None else src.nodata
+
+
+def _georeference(src):
+    """Source CRS and reproject arguments, GCP referenced rasters (e.g. S1 GRD) have no geotransform."""
+    gcps, gcp_crs = src.gcps
+    if src.crs is None and gcps:
+        return gcp_crs, {"gcps": gcps}
+    return src.crs, {"src_transform": src.transform}
+
+
+def _dest_grid(src, crs):
+    src_crs, georef = _georeference(src)
+    if "gcps" in georef:
+        return calculate_default_transform(src_crs, crs, src.width, src.height, gcps=georef["gcps"])
+    return calculate_default_transform(src_crs, crs, src.width, src.height, *src.bounds)
+
+
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+
+# rows preprocessed at a time, a full scene band never has to fit in memory
+PREPROCESS_ROWS = int(os.environ.get("PREPROCESS_ROWS", 256))
+
+
+def preprocess_band(ctx, band: str, src, dest: str):
+    """Run the product preprocess over `src` chunk by chunk into a float32 tiff with the same georeferencing."""
+    meta = {"folder": ctx.folder, "granule": ctx.band_granules[band], "processing": _processing(ctx), "width": src.width}
+    fn = ctx.product["preprocess"](band, meta)
+    kwargs = src.meta.copy()
+    kwargs.update({
+        'count': 1,
+        'dtype': np.float32,
+        'driver': GTIFF_DRIVER,
+        'tiled': True,
+        'BIGTIFF': 'IF_SAFER'
+    })
+    gcps, gcp_crs = src.gcps
+    if gcps:
+        del kwargs['transform']
+        kwargs.update({'crs': gcp_crs, 'gcps': gcps})
+    with rasterio.open(dest, "w", **kwargs) as dst:
+        for row_off in range(0, src.height, PREPROCESS_ROWS):
+            window = windows.Window(0, row_off, src.width, min(PREPROCESS_ROWS, src.height - row_off))
+            dst.write(fn(src.read(1, window=window), row_off).astype(np.float32), 1, window=window)
+
+
+def warp_band(ctx, band: str, dest: str):
+    """Project a full band to the request CRS. The result does not depend on the request area so it is shared through the cache."""
+    band_def = ctx.product["bands"][band]
+    preprocess = ctx.product.get("preprocess", None)
+    with rasterio.Env(**ctx.resources.env()):
+        with rasterio.open(ctx.band_files[band], driver=ctx.product["granules"]["driver"]) as src:
+            src_crs, georef = _georeference(src)
+            nodata = _nodata(band_def, src)
+            transform, new_width, new_height = _dest_grid(src, ctx.crs)
+            kwargs = src.meta.copy()
+            kwargs.update({
+                'crs': ctx.crs,
+                'transform': transform,
+                'width': new_width,
+                'height': new_height,
+                'count': 1,
+                'dtype': np.float32,
+                'nodata': nodata,
+                'driver': GTIFF_DRIVER,
+                'tiled': True,
+                'compress': 'deflate',
+                'BIGTIFF': 'IF_SAFER'
+            })
+            source = src
+            if preprocess:
+                preprocessed = f"{ctx.temp_dir}/{ctx.product_name}_{band}_preprocessed.tiff"
+                preprocess_band(ctx, band, src, preprocessed)
+                source = rasterio.open(preprocessed)
+            with source, rasterio.open(dest, "w", **kwargs) as band_dst:
                 reproject(
-                    source=rasterio.band(src, 1),
-                    destination=dest,
-                    src_transform=unproj.transform,
-                    src_crs=unproj.crs,
+                    source=rasterio.band(source, 1),
+                    destination=rasterio.band(band_dst, 1),
+                    src_crs=src_crs,
+                    src_nodata=nodata,
                     dst_transform=transform,
-                    dst_crs=DEST_CRS,
+                    dst_crs=ctx.crs,
+                    dst_nodata=nodata,
                     resampling=Resampling.nearest,
-                    num_threads=32,
-                    warp_mem_limit=256)
-                # convert band data to common format
-                band_def = ctx.product["bands"][band]
-                input_unit = ctx.setup["input"]["units"][band_idx]
-                input_unit = band_def["defaultUnit"] if input_unit == "DEFAULT" or input_unit not in band_def["units"] else input_unit
-                dest = band_def["units"][input_unit]["convert"](dest.astype(np.float32))
-
-                band_dst.write(dest, 1)
-            src.close()
-            with proj_band.open() as mask_src:
-                data, transform = rasterio.mask.mask(mask_src, shapes=_get_features(geo), all_touched=True, crop=True, filled=True)
-                data = data.astype(np.float32)
-
-                with rasterio.open(
-                    band_output_loc, 
-                    "w", 
-                    driver=GTIFF_DRIVER, 
-                    width=ctx.request.output.width, 
-                    height=ctx.request.output.height, 
-                    count=1, 
-                    crs=DEST_CRS, 
-                    transform=transform, 
-                    dtype=np.float32
-                ) as output:
-                    output.write(data)
-                    output.close()
-                    print("wrote file to", band_output_loc)
-
-async def render(ctx, vectorized_evalscript=False):
-    bands = ctx.setup["input"]["bands"]
-    loop = asyncio.get_event_loop()
-    tasks = []
-    start_proj_mask_time = time.time()
-    for i, band in enumerate(bands):
-        tasks.append(loop.run_in_executor(None, rerender_band, ctx, band, i))
-
-    await asyncio.gather(*tasks)
-
-    print("projection and masking took ", time.time() - start_proj_mask_time, " seconds")
-    # reopen all processed and masked bands and run processing on it
-    srcs = [
-        rasterio.open(ctx.temp_dir + "/" + band + "_projmask.tiff", driver=GTIFF_DRIVER)
-        for band in bands
-    ]
-    start_pixel_time = time.time()
-    with rasterio.Env(GDAL_NUM_THREADS=32):
-        # load data from bands into one numpy array
-        data = np.stack([src.read(1) for src in srcs])
-        # do per-pixel preprocessing on masked data
+                    num_threads=ctx.resources.threads,
+                    warp_mem_limit=ctx.resources.warp_mem_mb,
+                    **georef)
+                # cached overviews serve downsampled reads without touching full resolution
+                band_dst.build_overviews(OVERVIEW_LEVELS, Resampling.average)
+            if preprocess:
+                os.remove(preprocessed)
+    print("warped", ctx.band_files[band], "to", dest)
+
+
+resampling_methods = {
+    "NEAREST": Resampling.nearest,
+    "BILINEAR": Resampling.bilinear,
+    "BICUBIC": Resampling.cubic,
+    "AVERAGE": Resampling.average,
+}
+
+# extra source pixels read around the area so the kernels have full support at the edges
+KERNEL_PADDING = 4
+
+
+def estimate_pixels(req) -> int:
+    """Rough output size of a request, used to size its resource allocation."""
+    points = request_bounds(req)
+    output = req.output
+    if output.width and output.height:
+        return output.width * output.height
+    if output.resx and output.resy:
+        return int((points[2] - points[0]) / output.resx * (points[3] - points[1]) / output.resy)
+    # native resolution, assume a full Sentinel-2 tile
+    return 10980 * 10980
+
+
+class OutputGrid:
+    """The output raster in the request CRS, and the blocks of it that touch the area of interest."""
+
+    def __init__(self, transform, width, height, block_size, mask, tiles, inside):
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.block_size = block_size
+        # pixels inside the geometry, None when the whole bbox is wanted
+        self.mask = mask
+        # every block in row-major order, and whether it touches the area
+        self.tiles = tiles
+        self.inside = inside
+
+
+def output_grid(ctx, native_res: float) -> OutputGrid:
+    points = request_bounds(ctx.request)
+    output = ctx.request.output
+    span_x = points[2] - points[0]
+    span_y = points[3] - points[1]
+    if output.width and output.height:
+        width, height = output.width, output.height
+    elif output.resx and output.resy:
+        width, height = round(span_x / output.resx), round(span_y / output.resy)
+    else:
+        width, height = round(span_x / native_res), round(span_y / native_res)
+    width, height = max(width, 1), max(height, 1)
+    transform = from_bounds(*points, width, height)
+
+    mask = None
+    geometry = ctx.request.input.bounds.geometry
+    if geometry:
+        # rasterized once, every band and the evalscript only look at blocks it touches
+        mask = features.geometry_mask([geometry], out_shape=(height, width), transform=transform, all_touched=True, invert=True)
+    # small outputs get a single block no bigger than themselves
+    block_size = min(BLOCK_SIZE, -(-max(width, height) // 16) * 16)
+    tiles = []
+    inside = []
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            window = windows.Window(col, row, min(block_size, width - col), min(block_size, height - row))
+            tiles.append(window)
+            inside.append(mask is None or bool(mask[window.toslices()].any()))
+    print(sum(inside), "of", len(tiles), "blocks inside the area of interest")
+    return OutputGrid(transform, width, height, block_size, mask, tiles, inside)
+
+
+def _native_res(ctx, path, driver) -> float:
+    with rasterio.open(path, driver=driver) as src:
+        return _dest_grid(src, ctx.crs)[0].a
+
+
+async def make_grid(ctx, band) -> OutputGrid:
+    scheduler = get_scheduler()
+    native_res = None
+    output = ctx.request.output
+    if not (output.width and output.height) and not (output.resx and output.resy):
+        # native resolution output, take it from the first band
+        path, driver = await _band_source(ctx, band)
+        native_res = await scheduler.run(_native_res, ctx, path, driver)
+    return await scheduler.run(output_grid, ctx, native_res)
+
+
+def _padded_window(ds, bounds, pad):
+    window = windows.from_bounds(*bounds, transform=ds.transform)
+    window = windows.Window(window.col_off - pad, window.row_off - pad, window.width + 2 * pad, window.height + 2 * pad)
+    window = window.round_offsets().round_lengths()
+    full = windows.Window(0, 0, ds.width, ds.height)
+    if not windows.intersect(window, full):
+        return None
+    return window.intersection(full)
+
+
+def _read_decimated(src, bounds, scale):
+    """Read `bounds` from the coarsest resolution level of src that is still finer than `scale` times native."""
+    factor = 1
+    for level in src.overviews(1):
+        if level <= scale:
+            factor = level
+    window = _padded_window(src, bounds, KERNEL_PADDING * factor)
+    if window is None:
+        return None
+    out_shape = (max(int(window.height // factor), 1), max(int(window.width // factor), 1))
+    # GDAL serves the read from the matching JP2 resolution level or overview, no full resolution decode
+    data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+    transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1], window.height / out_shape[0])
+    return data, transform
+
+
+def derive_band(ctx, band: str, dest: str):
+    """Compute a derived band from its source asset, on the asset's own (coarse) grid."""
+    band_def = ctx.product["bands"][band]
+    with rasterio.Env(**ctx.resources.env()):
+        with rasterio.open(ctx.band_files[band], driver=ctx.product["granules"]["driver"]) as src:
+            data = band_def["derive"]["fn"](src.read())
+            kwargs = src.meta.copy()
+            kwargs.update({
+                'count': 1,
+                'dtype': data.dtype,
+                'nodata': band_def["nodata"],
+                'driver': GTIFF_DRIVER,
+                'tiled': True,
+                'compress': 'deflate'
+            })
+        with rasterio.open(dest, "w", **kwargs) as band_dst:
+            band_dst.write(data, 1)
+            band_dst.build_overviews(OVERVIEW_LEVELS, Resampling.nearest if band_def.get("categorical") else Resampling.average)
+    print("derived", band, "from", ctx.band_files[band])
+
+
+async def _band_source(ctx, band):
+    """Path and driver to read `band` from, deriving and caching it per product first if needed."""
+    if "derive" not in ctx.product["bands"][band]:
+        return ctx.band_files[band], ctx.product["granules"]["driver"]
+    path = await cached_file(
+        get_cache(),
+        f"masks/{ctx.product_name}/{band}.tiff",
+        f"{ctx.temp_dir}/{ctx.product_name}_{band}_derived.tiff",
+        lambda dest: derive_band(ctx, band, dest),
+        get_scheduler().run
+    )
+    return path, GTIFF_DRIVER
+
+
+async def _warped_source(ctx, band) -> str:
+    """Path of `band` warped whole to the request CRS, warped scenes are reused by every worker sharing the cache."""
+    variant = ctx.product.get("cacheVariant", None)
+    suffix = "_" + variant(_processing(ctx)) if variant else ""
+    crs_tag = ctx.crs.replace(":", "")
+    return await cached_file(
+        get_cache(),
+        f"warped/{ctx.product_name}/{band}{suffix}_{crs_tag}.tiff",
+        f"{ctx.temp_dir}/{ctx.product_name}_{band}_proj.tiff",
+        lambda dest: warp_band(ctx, band, dest),
+        get_scheduler().run
+    )
+
+
+class BandReader:
+    """One band of one scene, resampled onto blocks of the output grid. The source stays open between blocks.
+
+    Sources that can not be read block by block (`direct` is False) have to be
+    swapped for their warped scene with use_warped before reading.
+    """
+
+    def __init__(self, ctx, band, unit, path, driver):
+        self.ctx = ctx
+        self.band = band
+        processing = _processing(ctx)
+        band_def = ctx.product["bands"][band]
+        unit = band_def["defaultUnit"] if unit == "DEFAULT" or unit not in band_def["units"] else unit
+        self.convert = band_def["units"][unit]["convert"]
+
+        with rasterio.Env(**ctx.resources.env()):
+            src = rasterio.open(path, driver=driver)
+            src_crs, georef = _georeference(src)
+            self.nodata = _nodata(band_def, src)
+            # what pixels no scene has data for end up as
+            self.fill = np.float32(self.convert(np.float32(self.nodata if self.nodata is not None else 0)))
+            scale = ctx.grid.transform.a / _dest_grid(src, ctx.crs)[0].a
+            self.resampling = resampling_methods[processing.downsampling if scale > 1 else processing.upsampling]
+            if band_def.get("categorical"):
+                # class values can not be interpolated
+                self.resampling = Resampling.nearest
+            self.scale = max(scale, 1)
+
+            derived = "derive" in band_def
+            # blocks are reprojected straight from a source window, only sources without a geotransform
+            # or that need preprocessing over the whole scene are warped first
+            self.direct = "src_transform" in georef and (derived or not ctx.product.get("preprocess", None))
+            # downsampling reads start from the decimated source level and let the kernel do the rest
+            self.src = src
+            self.src_crs = src_crs
+        print("reading", band, "of", ctx.product_name, "directly" if self.direct else "from warped scene", "at scale", scale)
+
+    def use_warped(self, path):
+        self.src.close()
+        self.src = rasterio.open(path)
+        self.src_crs = self.src.crs
+
+    def read_block(self, window):
+        """Converted data of the band for one block of the output grid, NaN where the scene has no data."""
+        ctx = self.ctx
+        grid = ctx.grid
+        block = np.full((window.height, window.width), np.nan, dtype=np.float32)
+        with rasterio.Env(**ctx.resources.env()):
+            src_bounds = transform_bounds(ctx.crs, self.src_crs, *windows.bounds(window, grid.transform), densify_pts=21)
+            read = _read_decimated(self.src, src_bounds, self.scale)
+            # nothing to read when the block is outside of this scene
+            if read is not None:
+                data, data_transform = read
+                reproject(
+                    source=data,
+                    destination=block,
+                    src_transform=data_transform,
+                    src_crs=self.src_crs,
+                    src_nodata=self.nodata,
+                    dst_transform=windows.transform(window, grid.transform),
+                    dst_crs=ctx.crs,
+                    dst_nodata=np.nan,
+                    resampling=self.resampling,
+                    num_threads=ctx.resources.threads,
+                    warp_mem_limit=ctx.resources.warp_mem_mb)
+        # convert band data to common format
+        return self.convert(block).astype(np.float32)
+
+    def close(self):
+        self.src.close()
+
+
+# scenes combined at most for a per-pixel leastCC composite
+MOSAIC_MAX_SCENES = int(os.environ.get("MOSAIC_MAX_SCENES", 3))
+
+
+class TileRenderer:
+    """Renders the output block by block, in row-major order.
+
+    Each block is read from the scenes in order. Pixels missing in a scene, and
+    with a cloud mask the cloudy ones, are filled from the next one until the
+    block is complete, so later scenes are only downloaded when a block needs them.
+    """
+
+    def __init__(self, ctx, scenes, vectorized_evalscript=False):
+        self.ctx = ctx
+        self.scenes = scenes
+        self.vectorize = vectorized_evalscript
+        self.bands = ctx.setup["input"]["bands"]
+        self.units = ctx.setup["input"]["units"]
+        self.mask_band = ctx.product.get("cloudMask", None) if len(scenes) > 1 else None
+        self.extra_mask = self.mask_band is not None and self.mask_band not in self.bands
+        if self.extra_mask:
+            self.bands = self.bands + [self.mask_band]
+            self.units = self.units + ["DEFAULT"]
+        self.readers = []
+        # scenes downloaded so far, in order
+        self.fetched = 0
+        # executor work still running, datasets may only be closed once it is done
+        self.pending = set()
+        self.count = ctx.setup["output"]["bands"]
+        self.sample_type = ctx.setup["output"]["sampleType"]
+        self.dtype = sample_type_to_dtype[self.sample_type]
+
+    def _run(self, fn, *args):
+        future = get_scheduler().submit(fn, *args)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return asyncio.wrap_future(future)
+
+    async def _open_band(self, band, unit):
+        # cache lookups and waits for other workers happen here, not on render threads
+        path, driver = await _band_source(self.ctx, band)
+        reader = await self._run(BandReader, self.ctx, band, unit, path, driver)
+        if not reader.direct:
+            await self._run(reader.use_warped, await _warped_source(self.ctx, band))
+        return reader
+
+    async def _fetch(self, i):
+        if i == self.fetched:
+            await download(self.ctx, self.scenes[i], self.bands)
+            self.fetched += 1
+
+    async def fetch(self):
+        """Download the first scene. Only needs the network, not a render slot."""
+        await self._fetch(0)
+
+    async def _scene_readers(self, i):
+        if i == len(self.readers):
+            ctx = self.ctx
+            await self._fetch(i)
+            if ctx.grid is None:
+                ctx.grid = await make_grid(ctx, self.bands[0])
+            self.readers.append(await asyncio.gather(*[
+                self._open_band(band, unit) for band, unit in zip(self.bands, self.units)
+            ]))
+        return self.readers[i]
+
+    async def prepare(self):
+        """Open the first scene and lay out the output grid."""
+        await self._scene_readers(0)
+
+    async def _read_block(self, window):
+        grid = self.ctx.grid
+        data = None
+        for i in range(len(self.scenes)):
+            readers = await self._scene_readers(i)
+            scene_data = np.stack(await asyncio.gather(*[self._run(reader.read_block, window) for reader in readers]))
+            missing = np.isnan(scene_data).any(axis=0)
+            wanted = missing
+            if self.mask_band:
+                # CLM is 0 for clear pixels, 1 for clouds and 255 for no data
+                wanted = missing | (scene_data[self.bands.index(self.mask_band)] != 0)
+            if self.extra_mask:
+                scene_data = scene_data[:-1]
+            if data is None:
+                data, todo = scene_data, wanted
+                if grid.mask is not None:
+                    todo &= grid.mask[window.toslices()]
+            else:
+                # clear pixels replace what is still wanted. Cloudy ones only fill pixels no scene
+                # had data for yet, so overcast pixels keep the least cloudy scene
+                take = todo & (~wanted | (np.isnan(data).any(axis=0) & ~missing))
+                data[:, take] = scene_data[:, take]
+                todo &= wanted
+            if not todo.any():
+                break
+        # pixels no scene has data for get the nodata value of their band
+        for band, reader in enumerate(self.readers[0][:len(data)]):
+            data[band][np.isnan(data[band])] = reader.fill
+        return data
+
+    def _evaluate(self, data, window):
+        """Run the evalscript over a block and convert it to the output sample type."""
+        ctx = self.ctx
+        mask = ctx.grid.mask[window.toslices()] if ctx.grid.mask is not None else None
+        # the cloud mask is only there for the mosaic, evalscripts see the bands they asked for
+        bands = self.bands[:-1] if self.extra_mask else self.bands
         if ctx.evaluatePixelFunction:
-            print("running evalscript")
-            vectorize = vectorized_evalscript
             px = PixelProcessor(
                 ctx.evaluatePixelFunction,
                 ctx.product["sampleHolder"],
                 bands,
-                vectorize=vectorize
+                vectorize=self.vectorize
             )
-            if vectorize:
-                data = np.stack(px.process(data))
+            if mask is None:
+                if self.vectorize:
+                    data = np.stack(px.process(data))
+                else:
+                    data = np.apply_along_axis(px.process, 0, data)
             else:
-                data = np.apply_along_axis(px.process, 0, data)
-        print("pixel processing took ", time.time() - start_pixel_time, " seconds")
-        # write output
-        count = ctx.setup["output"]["bands"]
-        sampleType = ctx.setup['output']["sampleType"]
-        wanted_dtype = sample_type_to_dtype[sampleType]
-        output_loc = ctx.temp_dir + "/" + "output.tiff"
-
-        # everything is now projected to WSG84
-        unproj = srcs[0]
-        transform, _, _ = calculate_default_transform(
-            unproj.crs, DEST_CRS, unproj.width, unproj.height, *unproj.bounds)
-        with rasterio.open(
-            output_loc, 
-            "w", 
-            driver=GTIFF_DRIVER, 
-            width=ctx.request.output.width, 
-            height=ctx.request.output.height, 
-            count=count, 
-            crs=DEST_CRS, 
-            transform=transform, 
-            dtype=wanted_dtype
-        ) as output:
-            if sampleType == "AUTO":
-                print("auto mode, scaling data")
-                data = data * 255
-            data = data.astype(wanted_dtype)
-            output.write(data)
-            output.close()
-            print("wrote file to", output_loc)
\ No newline at end of file
+                # only pixels inside the geometry are evaluated, as a (bands, pixels, 1) image
+                inside = data[:, mask]
+                if self.vectorize:
+                    result = np.stack(px.process(inside[:, :, None]))[:, :, 0]
+                else:
+                    result = np.apply_along_axis(px.process, 0, inside)
+                data = np.zeros((result.shape[0],) + mask.shape, dtype=result.dtype)
+                data[:, mask] = result
+        elif mask is not None:
+            data[:, ~mask] = 0
+        if self.sample_type == "AUTO":
+            data = data * 255
+        return data.astype(self.dtype)
+
+    async def tiles(self):
+        """Yield (window, data) for every block of the grid, data is None for blocks outside the area."""
+        grid = self.ctx.grid
+        for window, inside in zip(grid.tiles, grid.inside):
+            if not inside:
+                yield window, None
+                continue
+            data = await self._read_block(window)
+            yield window, await self._run(self._evaluate, data, window)
+
+    async def close(self):
+        # a cancelled or failed block leaves reads running in the executor, closing their datasets under them crashes GDAL
+        pending = list(self.pending)
+        if pending:
+            await asyncio.wait([asyncio.wrap_future(future) for future in pending])
+        for readers in self.readers:
+            for reader in readers:
+                reader.close()
+
+
+def _tiff_stream(ctx, renderer: TileRenderer) -> TiledTiffStream:
+    grid = ctx.grid
+    crs = CRS.from_user_input(ctx.crs)
+    return TiledTiffStream(
+        grid.width, grid.height, renderer.count, renderer.dtype, grid.block_size,
+        grid.transform, crs.to_epsg(), crs.is_geographic, grid.inside
+    )
+
+
+def streamable(ctx, renderer: TileRenderer) -> bool:
+    """Whether the prepared output can be streamed, it has to fit an uncompressed classic tiff with an EPSG crs."""
+    grid = ctx.grid
+    return CRS.from_user_input(ctx.crs).to_epsg() is not None and \
+        TiledTiffStream.fits(grid.width, grid.height, renderer.count, renderer.dtype, grid.block_size)
+
+
+async def write_tiles(ctx, renderer: TileRenderer):
+    """Render every block of a prepared renderer into output.tiff."""
+    start_time = time.time()
+    grid = ctx.grid
+    output_loc = ctx.temp_dir + "/" + "output.tiff"
+    with rasterio.open(
+        output_loc, 
+        "w", 
+        driver=GTIFF_DRIVER, 
+        width=grid.width, 
+        height=grid.height, 
+        count=renderer.count, 
+        crs=ctx.crs, 
+        transform=grid.transform, 
+        dtype=renderer.dtype,
+        tiled=True,
+        blockxsize=grid.block_size,
+        blockysize=grid.block_size,
+        compress="deflate"
+    ) as output:
+        async for window, data in renderer.tiles():
+            if data is not None:
+                output.write(data, window=window)
+        print("wrote file to", output_loc)
+    print("rendering took ", time.time() - start_time, " seconds")
+
+
+# largest piece of a streamed output handed to the client at once
+STREAM_CHUNK = 1 << 20
+
+
+class StreamedOutput:
+    """A tiled tiff rendered to disk, that can be read back while it is being written.
+
+    render() writes the header and then each tile as soon as it is rendered, independent
+    of how fast clients read. chunks() follows the file, so a slow client never holds up
+    the render or its slot.
+    """
+
+    def __init__(self, ctx, renderer: TileRenderer, output_loc: str):
+        self.ctx = ctx
+        self.renderer = renderer
+        self.output_loc = output_loc
+        self.stream = _tiff_stream(ctx, renderer)
+        self.written = 0
+        self.finished = False
+        self.error = None
+        self.changed = asyncio.Event()
+
+    def _wrote(self, count):
+        self.written += count
+        self.changed.set()
+
+    async def render(self):
+        start_time = time.time()
+        try:
+            with open(self.output_loc, "wb") as output:
+                output.write(self.stream.header())
+                output.flush()
+                self._wrote(len(self.stream.header()))
+                first = True
+                async for window, data in self.renderer.tiles():
+                    if data is None:
+                        # sparse, nothing to write
+                        continue
+                    tile = self.stream.tile(data)
+                    output.write(tile)
+                    output.flush()
+                    self._wrote(len(tile))
+                    if first:
+                        print("first tile after ", time.time() - start_time, " seconds")
+                        first = False
+        except BaseException as err:
+            self.error = err
+            raise
+        finally:
+            self.finished = True
+            self.changed.set()
+        print("rendering", self.stream.size, "streamed bytes took ", time.time() - start_time, " seconds")
+
+    async def chunks(self):
+        """Yield the bytes of the output as render() writes them."""
+        sent = 0
+        # render() writes the header before anything else
+        while not self.written and not self.finished:
+            self.changed.clear()
+            await self.changed.wait()
+        with open(self.output_loc, "rb") as output:
+            while True:
+                if sent < self.written:
+                    chunk = output.read(min(self.written - sent, STREAM_CHUNK))
+                    sent += len(chunk)
+                    yield chunk
+                    continue
+                if self.finished:
+                    break
+                self.changed.clear()
+                await self.changed.wait()
+        if self.error is not None:
+            # the client gets a truncated tiff instead of a complete looking one
+            raise RuntimeError("rendering failed") from self.error
@@ -1,8 +1,50 @@
 SENTINEL_2_1C = "sentinel-2-l1c"
 SENTINEL_2_2A = "sentinel-2-l2a"
+SENTINEL_1_GRD = "sentinel-1-grd"
+DEM = "dem"
 
+import os
+import re
+import importlib
+import typing
+import xml.etree.ElementTree as ET
+
+import requests
 import numpy as np
 
+# Product definitions
+#
+# Every collection is a dict registered with register_product:
+#   "odata":        catalogue search terms, and whether the time range/cloud cover filters apply
+#   "granules":     "list" returns the asset paths of a product instance, "matching" picks one per band,
+#                   "driver" is the GDAL driver to open the assets with
+#   "bands":        source dtype, nodata value and unit conversions per band. "categorical" bands are
+#                   always resampled with nearest, "derive" bands are computed from another asset
+#                   ("asset" picks it from the product listing and instance, or returns None when the product
+#                   has none, "fn" maps its vectorized data to the band)
+#   "preprocess":   optional fn(band, meta) returning a vectorized fn(data, row_off), run over chunks of
+#                   rows of the band before it is warped
+#   "cacheVariant": optional fn(processing) naming the preprocess options the warped band depends on
+#   "cloudMask":    optional band (0 clear, 1 cloud, 255 no data) used for per-pixel leastCC mosaicking
+#   "cloudMaskAvailable": optional fn(product_instance), whether that product has the cloud mask
+#   "mosaicTiles":  products are disjoint tiles of one layer, every tile found is combined into the output
+#   "sampleHolder": class exposing the bands to evalscripts
+
+SUPPORTED_PRODUCTS = {}
+
+def register_product(name: str, definition: dict):
+    SUPPORTED_PRODUCTS[name] = definition
+
+
+def metadata_listing(granule_file: str, pattern: re.Pattern, extension: str = ""):
+    """Asset lister for products that enumerate their files in a metadata document."""
+    def list_granules(folder: str, product_instance) -> typing.List[str]:
+        url = folder + granule_file
+        print(url)
+        def_file = requests.get(url).text
+        return [gran + extension for gran in pattern.findall(def_file)]
+    return list_granules
+
 class SampleHolder:
     def __init__(self, bands, vectorize=False):
         self.bands = bands
@@ -17,9 +59,13 @@ class SampleHolder:
                 self.__dict__[self.bands[i]] = vals[i]
 
 # Sentinel 2 1C product
-            
+
+S2_IMAGE_FILE_RE = re.compile("<IMAGE_FILE>(.*)</IMAGE_FILE>")
+S2_FILE_EXT = ".jp2"
+
 s1c_optical_band = {
     "src": np.uint16,
+    "nodata": 0,
     "defaultUnit": "REFLECTANCE",
     "units": {
         "REFLECTANCE": {
@@ -31,12 +77,57 @@ s1c_optical_band = {
     }
 }
 
+# cloud masks follow Sentinel Hub: CLM is 0 clear, 1 cloud, 255 no data, CLP a 0-255 cloud probability
+
+def cloud_mask_band(asset, fn, categorical):
+    return {
+        "src": np.uint8,
+        "nodata": 255,
+        "categorical": categorical,
+        "defaultUnit": "DN",
+        "units": {
+            "DN": {
+                "convert": lambda x: x
+            }
+        },
+        "derive": {
+            "asset": asset,
+            "fn": fn
+        }
+    }
+
+S2_BASELINE_RE = re.compile(r"_N(\d{4})_")
+
+def s2_has_classi(product_instance) -> bool:
+    # MSK_CLASSI only exists from processing baseline 04.00, older products have GML masks
+    baseline = S2_BASELINE_RE.search(product_instance["Name"])
+    return baseline is not None and int(baseline.group(1)) >= 400
+
+def s2_classi_asset(granules, product_instance):
+    if not s2_has_classi(product_instance):
+        return None
+    # MSK_CLASSI sits next to the image data of the granule
+    for gran in granules:
+        if "/IMG_DATA/" in gran:
+            return gran.split("/IMG_DATA/")[0] + "/QI_DATA/MSK_CLASSI_B00.jp2"
+    return None
+
+def s2_classi_clm(data):
+    # bands of MSK_CLASSI: opaque clouds, cirrus, snow
+    return ((data[0] > 0) | (data[1] > 0)).astype(np.uint8)
+
+def s2_classi_clp(data):
+    clp = np.zeros(data.shape[1:], dtype=np.uint8)
+    clp[data[1] > 0] = 100
+    clp[data[0] > 0] = 230
+    return clp
+
 def sentinel_2_1c_matching(bands, granules):
     needed = [f"_{band}" for band in bands]
     matched_granules = [gran for gran in granules if any(True for need in needed if need in gran)]
     if len(matched_granules) == len(bands):
-        return matched_granules
-    return []
+        return {band: [gran for gran in matched_granules if f"_{band}" in gran][0] for band in bands}
+    return {}
 
 class S2L1CSampleHolder(SampleHolder):
     def __init__(self, bands, vectorize):
@@ -62,6 +153,7 @@ class S2L1CSampleHolder(SampleHolder):
 
 s2a_optical_band = {
     "src": np.uint16,
+    "nodata": 0,
     "defaultUnit": "REFLECTANCE",
     "units": {
         "REFLECTANCE": {
@@ -75,6 +167,7 @@ s2a_optical_band = {
 
 dn_band = {
     "src": np.uint8,
+    "nodata": 0,
     "defaultUnit": "DN",
     "units": {
         "DN": {
@@ -83,14 +176,35 @@ dn_band = {
     }
 }
 
+scl_band = {**dn_band, "categorical": True}
+
+# scene classes: 0 no data, 3 cloud shadows, 8 cloud medium probability, 9 cloud high probability, 10 thin cirrus
+SCL_TO_CLM = np.zeros(256, dtype=np.uint8)
+SCL_TO_CLM[[8, 9, 10]] = 1
+SCL_TO_CLM[0] = 255
+
+# SCL only has classes, estimate a probability per class
+SCL_TO_CLP = np.zeros(256, dtype=np.uint8)
+SCL_TO_CLP[8] = 150
+SCL_TO_CLP[9] = 230
+SCL_TO_CLP[10] = 100
+SCL_TO_CLP[0] = 255
+
+def s2a_scl_asset(granules, product_instance):
+    for res in ["20m", "60m"]:
+        found = [gran for gran in granules if f"_SCL_{res}" in gran]
+        if found:
+            return found[0]
+    return None
+
 sentinel_2_2a_resolutions = ["10m", "20m", "60m"]
 def sentinel_2_2a_matching(bands, granules):
     for res in sentinel_2_2a_resolutions:
         needed = [f"{band}_{res}" for band in bands]
         matched_granules = [gran for gran in granules if any(True for need in needed if need in gran)]
         if len(matched_granules) == len(bands):
-            return matched_granules
-    return []
+            return {band: [gran for gran in matched_granules if f"_{band}" in gran][0] for band in bands}
+    return {}
         
 class S2L2ASampleHolder(SampleHolder):
     def __init__(self, bands, vectorize):
@@ -117,65 +231,224 @@ class S2L2ASampleHolder(SampleHolder):
         self.CLM = 0"""
 
 
-SUPPORTED_PRODUCTS = {
-    SENTINEL_2_1C: {
-        "odata": {
-            "searchTerms": ["Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq 'S2MSI1C')"]
-        },
-        "granules": {
-            "granuleFile": "MTD_MSIL1C.xml",
-            "matching": sentinel_2_1c_matching
-        },
-        "bands": {
-            "B01": s1c_optical_band,
-            "B02": s1c_optical_band,
-            "B03": s1c_optical_band,
-            "B04": s1c_optical_band,
-            "B05": s1c_optical_band,
-            "B06": s1c_optical_band,
-            "B07": s1c_optical_band,
-            "B07": s1c_optical_band,
-            "B08": s1c_optical_band,
-            "B09": s1c_optical_band,
-            "B8A": s1c_optical_band,
-            "B09": s1c_optical_band,
-            "B11": s1c_optical_band,
-            "B12": s1c_optical_band,
-            "CLP": dn_band,
-            "CLM": dn_band
-        },
-        "sampleHolder": S2L1CSampleHolder
+register_product(SENTINEL_2_1C, {
+    "odata": {
+        "searchTerms": ["Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq 'S2MSI1C')"],
+        "timeRange": True,
+        "cloudCover": True
     },
-    SENTINEL_2_2A: {
-        "odata": {
-            "searchTerms": ["Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq 'S2MSI2A')"]
-        },
-        "granules": {
-            "granuleFile": "MTD_MSIL2A.xml",
-            "matching": sentinel_2_2a_matching
-        },
-        "bands": {
-            "B01": s2a_optical_band,
-            "B02": s2a_optical_band,
-            "B03": s2a_optical_band,
-            "B04": s2a_optical_band,
-            "B05": s2a_optical_band,
-            "B06": s2a_optical_band,
-            "B07": s2a_optical_band,
-            "B07": s2a_optical_band,
-            "B08": s2a_optical_band,
-            "B09": s2a_optical_band,
-            "B8A": s2a_optical_band,
-            "B09": s2a_optical_band,
-            "B11": s2a_optical_band,
-            "B12": s2a_optical_band,
-            "AOT": s2a_optical_band,
-            "SCL": dn_band,
-            "SNW": dn_band,
-            "CLD": dn_band,
-            "CLP": dn_band,
-            "CLM": dn_band
+    "granules": {
+        "list": metadata_listing("MTD_MSIL1C.xml", S2_IMAGE_FILE_RE, S2_FILE_EXT),
+        "matching": sentinel_2_1c_matching,
+        "driver": "JP2OpenJPEG"
+    },
+    "bands": {
+        "B01": s1c_optical_band,
+        "B02": s1c_optical_band,
+        "B03": s1c_optical_band,
+        "B04": s1c_optical_band,
+        "B05": s1c_optical_band,
+        "B06": s1c_optical_band,
+        "B07": s1c_optical_band,
+        "B07": s1c_optical_band,
+        "B08": s1c_optical_band,
+        "B09": s1c_optical_band,
+        "B8A": s1c_optical_band,
+        "B09": s1c_optical_band,
+        "B11": s1c_optical_band,
+        "B12": s1c_optical_band,
+        "CLP": cloud_mask_band(s2_classi_asset, s2_classi_clp, False),
+        "CLM": cloud_mask_band(s2_classi_asset, s2_classi_clm, True)
+    },
+    "cloudMask": "CLM",
+    "cloudMaskAvailable": s2_has_classi,
+    "sampleHolder": S2L1CSampleHolder
+})
+
+register_product(SENTINEL_2_2A, {
+    "odata": {
+        "searchTerms": ["Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq 'S2MSI2A')"],
+        "timeRange": True,
+        "cloudCover": True
+    },
+    "granules": {
+        "list": metadata_listing("MTD_MSIL2A.xml", S2_IMAGE_FILE_RE, S2_FILE_EXT),
+        "matching": sentinel_2_2a_matching,
+        "driver": "JP2OpenJPEG"
+    },
+    "bands": {
+        "B01": s2a_optical_band,
+        "B02": s2a_optical_band,
+        "B03": s2a_optical_band,
+        "B04": s2a_optical_band,
+        "B05": s2a_optical_band,
+        "B06": s2a_optical_band,
+        "B07": s2a_optical_band,
+        "B07": s2a_optical_band,
+        "B08": s2a_optical_band,
+        "B09": s2a_optical_band,
+        "B8A": s2a_optical_band,
+        "B09": s2a_optical_band,
+        "B11": s2a_optical_band,
+        "B12": s2a_optical_band,
+        "AOT": s2a_optical_band,
+        "SCL": scl_band,
+        "SNW": dn_band,
+        "CLD": dn_band,
+        "CLP": cloud_mask_band(s2a_scl_asset, lambda data: SCL_TO_CLP[data[0]], False),
+        "CLM": cloud_mask_band(s2a_scl_asset, lambda data: SCL_TO_CLM[data[0]], True)
+    },
+    "cloudMask": "CLM",
+    "sampleHolder": S2L2ASampleHolder
+})
+
+
+# Sentinel 1 GRD product
+
+S1_MEASUREMENT_RE = re.compile(r'href="\./(measurement/[^"]+\.tiff)"')
+
+s1_backscatter_luts = {
+    "BETA0": "betaNought",
+    "SIGMA0_ELLIPSOID": "sigmaNought",
+    "GAMMA0_ELLIPSOID": "gamma",
+}
+
+s1_polarization_band = {
+    "src": np.uint16,
+    "nodata": 0,
+    "defaultUnit": "LINEAR_POWER",
+    "units": {
+        "LINEAR_POWER": {
+            "convert": lambda x: x
         },
-        "sampleHolder": S2L2ASampleHolder
+        "DB": {
+            "convert": lambda x: 10 * np.log10(np.maximum(x, 1e-10))
+        }
+    }
+}
+
+def sentinel_1_grd_matching(bands, granules):
+    matched_granules = {}
+    for band in bands:
+        found = [gran for gran in granules if f"-{band.lower()}-" in gran]
+        if not found:
+            return {}
+        matched_granules[band] = found[0]
+    return matched_granules
+
+def _calibration_vectors(xml: str, lut: str, width: int):
+    root = ET.fromstring(xml)
+    vectors = root.findall("calibrationVectorList/calibrationVector")
+    lines = np.array([int(vec.find("line").text) for vec in vectors])
+    pixels = np.array([int(px) for px in vectors[0].find("pixel").text.split()])
+    cols = np.arange(width)
+    # expand each vector along the range direction, azimuth is interpolated per chunk
+    values = np.stack([
+        np.interp(cols, pixels, [float(val) for val in vec.find(lut).text.split()])
+        for vec in vectors
+    ]).astype(np.float32)
+    return lines, values
+
+def sentinel_1_calibrate(band, meta):
+    """DN to backscatter coefficient, value = DN^2 / A^2 with A interpolated from the calibration LUT."""
+    lut = s1_backscatter_luts[meta["processing"].backCoeff]
+    calibration_file = meta["granule"].replace("measurement/", "annotation/calibration/calibration-").replace(".tiff", ".xml")
+    res = requests.get(meta["folder"] + calibration_file)
+    # an error page is not a calibration LUT
+    res.raise_for_status()
+    lines, values = _calibration_vectors(res.text, lut, meta["width"])
+
+    def calibrate(data, row_off):
+        rows = np.arange(row_off, row_off + data.shape[0])
+        idx = np.clip(np.searchsorted(lines, rows, side="right") - 1, 0, len(lines) - 2)
+        t = ((rows - lines[idx]) / (lines[idx + 1] - lines[idx])).astype(np.float32)[:, None]
+        a = values[idx] * (1 - t) + values[idx + 1] * t
+        dn = data.astype(np.float32)
+        return (dn * dn) / (a * a)
+    return calibrate
+
+class S1GRDSampleHolder(SampleHolder):
+    def __init__(self, bands, vectorize):
+        super().__init__(bands, vectorize)
+        """self.VV = 0
+        self.VH = 0
+        self.HH = 0
+        self.HV = 0"""
+
+register_product(SENTINEL_1_GRD, {
+    "odata": {
+        "searchTerms": [
+            "Collection/Name eq 'SENTINEL-1'",
+            "contains(Name,'_GRD')"
+        ],
+        "timeRange": True,
+        "cloudCover": False
+    },
+    "granules": {
+        "list": metadata_listing("manifest.safe", S1_MEASUREMENT_RE),
+        "matching": sentinel_1_grd_matching,
+        "driver": "GTiff"
+    },
+    "bands": {
+        "VV": s1_polarization_band,
+        "VH": s1_polarization_band,
+        "HH": s1_polarization_band,
+        "HV": s1_polarization_band
+    },
+    "preprocess": sentinel_1_calibrate,
+    "cacheVariant": lambda processing: processing.backCoeff,
+    "sampleHolder": S1GRDSampleHolder
+})
+
+
+# Copernicus DEM
+
+dem_band = {
+    "src": np.float32,
+    "nodata": None,
+    "defaultUnit": "METERS",
+    "units": {
+        "METERS": {
+            "convert": lambda x: x
+        }
     }
 }
+
+def dem_listing(folder: str, product_instance) -> typing.List[str]:
+    # COG tiles hold a single file named after their folder
+    return [product_instance["S3Path"].rstrip("/").split("/")[-1] + ".tif"]
+
+def dem_matching(bands, granules):
+    return {band: granules[0] for band in bands}
+
+class DEMSampleHolder(SampleHolder):
+    def __init__(self, bands, vectorize):
+        super().__init__(bands, vectorize)
+        """self.DEM = 0"""
+
+register_product(DEM, {
+    "odata": {
+        "searchTerms": [
+            "Collection/Name eq 'COP-DEM'",
+            "Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType' and att/OData.CSC.StringAttribute/Value eq 'DGE_30')"
+        ],
+        "timeRange": False,
+        "cloudCover": False
+    },
+    "granules": {
+        "list": dem_listing,
+        "matching": dem_matching,
+        "driver": "GTiff"
+    },
+    "bands": {
+        "DEM": dem_band
+    },
+    "mosaicTiles": True,
+    "sampleHolder": DEMSampleHolder
+})
+
+
+# extra collections, comma separated module names that call register_product when imported
+for plugin in os.environ.get("PRODUCT_PLUGINS", "").split(","):
+    if plugin.strip():
+        importlib.import_module(plugin.strip())
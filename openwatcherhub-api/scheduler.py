@@ -0,0 +1,81 @@
+import os
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+CPU_CORES = os.cpu_count() or 1
+
+# total GDAL threads all renders in this process may use together
+RENDER_THREADS = int(os.environ.get("RENDER_THREADS", CPU_CORES))
+# heavy renders running at the same time, the rest wait for a slot
+MAX_CONCURRENT_RENDERS = int(os.environ.get("MAX_CONCURRENT_RENDERS", max(1, CPU_CORES // 4)))
+# memory shared by the warpers of all running renders
+WARP_MEMORY_MB = int(os.environ.get("WARP_MEMORY_MB", 1024))
+# GDAL block cache, process wide. GDAL reads it from the environment on first use
+GDAL_CACHE_MB = int(os.environ.get("GDAL_CACHE_MB", 512))
+os.environ.setdefault("GDAL_CACHEMAX", str(GDAL_CACHE_MB))
+
+# below this many output pixels per thread extra threads cost more than they gain
+PIXELS_PER_THREAD = int(os.environ.get("PIXELS_PER_THREAD", 256 * 256))
+MIN_WARP_MEMORY_MB = 16
+
+
+class Allocation:
+    def __init__(self, threads: int, warp_mem_mb: int):
+        # threads and memory per band task
+        self.threads = threads
+        self.warp_mem_mb = warp_mem_mb
+
+    def env(self):
+        return {"GDAL_NUM_THREADS": self.threads}
+
+
+class ResourceScheduler:
+    """Hands out GDAL threads and warp memory to renders so they do not oversubscribe the machine."""
+
+    def __init__(self):
+        self.slots = asyncio.Semaphore(MAX_CONCURRENT_RENDERS)
+        self.executor = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix="render")
+        self.active = 0
+        self.threads_in_use = 0
+
+    def allocate(self, pixels: int, bands: int) -> Allocation:
+        bands = max(bands, 1)
+        # other processes on the box count against us too
+        busy = max(os.getloadavg()[0], self.threads_in_use)
+        free = max(1, int(CPU_CORES - busy))
+        fair_share = max(1, RENDER_THREADS // (self.active + 1))
+        by_size = max(1, pixels // PIXELS_PER_THREAD)
+        threads = max(1, min(free, fair_share, by_size) // bands)
+        warp_mem = max(MIN_WARP_MEMORY_MB, WARP_MEMORY_MB // MAX_CONCURRENT_RENDERS // bands)
+        return Allocation(threads, warp_mem)
+
+    @contextlib.asynccontextmanager
+    async def render_slot(self, pixels: int, bands: int):
+        async with self.slots:
+            alloc = self.allocate(pixels, bands)
+            self.active += 1
+            self.threads_in_use += alloc.threads * bands
+            print("render slot:", alloc.threads, "threads and", alloc.warp_mem_mb, "MB warp memory per band for", bands, "bands")
+            try:
+                yield alloc
+            finally:
+                self.active -= 1
+                self.threads_in_use -= alloc.threads * bands
+
+    async def run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    def submit(self, fn, *args) -> Future:
+        """Like run, but hands back the executor future, which keeps track of the work after the caller is cancelled."""
+        return self.executor.submit(fn, *args)
+
+
+_scheduler = None
+
+def get_scheduler() -> ResourceScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ResourceScheduler()
+    return _scheduler
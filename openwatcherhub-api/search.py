@@ -1,10 +1,22 @@
 import typing
 import requests
+from rasterio.warp import transform_bounds, transform_geom
 
 from models import ProcessRequest
-from process import ProcessContext
+from process import ProcessContext, request_crs, request_bounds
 
 BASE_URL = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter="
+CATALOGUE_CRS = "EPSG:4326"
+# longer polygons make for too long catalogue urls, their bbox is searched instead
+MAX_SEARCH_VERTICES = 200
+# results per catalogue page when every result is needed, the default page only holds 20
+CATALOGUE_PAGE = 1000
+# the catalogue refuses to skip further than this
+CATALOGUE_MAX_SKIP = 10000
+
+
+class TooManyResults(ValueError):
+    pass
 
 mosaicking_order_to_orderby = {
     "mostRecent": "ContentDate/Start desc",
@@ -28,19 +40,52 @@ def _bbox(corners: typing.List[float]) -> typing.List[str]:
     poly = f"POLYGON(({','.join(str(point[0]) + ' ' + str(point[1]) for point in points)}))"
     return [f"OData.CSC.Intersects(area=geography'SRID=4326;{poly}')"]
 
+def _wkt_polygon(rings) -> str:
+    return "(" + ",".join("(" + ",".join(f"{point[0]} {point[1]}" for point in ring) + ")" for ring in rings) + ")"
+
+def _geometry(geometry: dict) -> typing.List[str]:
+    if geometry["type"] == "Polygon":
+        poly = "POLYGON" + _wkt_polygon(geometry["coordinates"])
+    else:
+        poly = "MULTIPOLYGON(" + ",".join(_wkt_polygon(rings) for rings in geometry["coordinates"]) + ")"
+    return [f"OData.CSC.Intersects(area=geography'SRID=4326;{poly}')"]
+
+def _area(ctx: ProcessContext) -> typing.List[str]:
+    crs = request_crs(ctx.request)
+    geometry = ctx.request.input.bounds.geometry
+    if geometry:
+        geometry = transform_geom(crs, CATALOGUE_CRS, geometry)
+        coordinates = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        if sum(len(ring) for rings in coordinates for ring in rings) <= MAX_SEARCH_VERTICES:
+            return _geometry(geometry)
+    return _bbox(transform_bounds(crs, CATALOGUE_CRS, *request_bounds(ctx.request), densify_pts=21))
+
 def _between(start_date: str, end_date: str) -> typing.List[str]:
     return [
         f"ContentDate/Start gt {start_date}",
         f"ContentDate/Start lt {end_date}",
     ]
 
+def _all_pages(req_url: str) -> typing.List[dict]:
+    ret = []
+    while True:
+        page = requests.get(f"{req_url}&$top={CATALOGUE_PAGE}&$skip={len(ret)}").json()['value']
+        ret += page
+        if len(page) < CATALOGUE_PAGE:
+            return ret
+        if len(ret) >= CATALOGUE_MAX_SKIP:
+            raise TooManyResults(f"More than {len(ret)} products cover the area, request a smaller area.")
+
 def search(ctx: ProcessContext):
-    baseFilters = _bbox(ctx.request.input.bounds.bbox)
+    baseFilters = _area(ctx)
 
     for data in ctx.request.input.data:
-        filters =  ctx.product["odata"]["searchTerms"] + baseFilters
-        filters += _between(data.dataFilter.timeRange.from_, data.dataFilter.timeRange.to)
-        filters += _maxCloudCover(data.dataFilter.maxCloudCoverage)
+        odata = ctx.product["odata"]
+        filters =  odata["searchTerms"] + baseFilters
+        if odata["timeRange"]:
+            filters += _between(data.dataFilter.timeRange.from_, data.dataFilter.timeRange.to)
+        if odata["cloudCover"]:
+            filters += _maxCloudCover(data.dataFilter.maxCloudCoverage)
 
         filter_str = ' and '.join(filters)
 
@@ -48,10 +93,13 @@ def search(ctx: ProcessContext):
 
         req_url = BASE_URL + filter_str + "&$orderby=" + orderby + "&$expand=Attributes"
         print(req_url)
-        res = requests.get(req_url)
-
-        ret = res.json()['value']
-        if data.dataFilter.mosaickingOrder == "leastCC":
+        if ctx.product.get("mosaicTiles", False):
+            # every tile of the area is rendered, none may be cut off by the page size
+            ret = _all_pages(req_url)
+        else:
+            res = requests.get(req_url)
+            ret = res.json()['value']
+        if data.dataFilter.mosaickingOrder == "leastCC" and odata["cloudCover"]:
             # sort by cloud coverage
             print("resort the array")
             ret = sorted(ret, key=lambda key: [attr['Value'] for attr in key["Attributes"] if attr["Name"] == "cloudCover"][0])
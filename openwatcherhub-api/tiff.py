@@ -0,0 +1,115 @@
+import struct
+import numpy as np
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+DOUBLE = 12
+type_formats = {SHORT: "H", LONG: "I", DOUBLE: "d"}
+
+sample_formats = {"u": 1, "i": 2, "f": 3}
+
+MAX_CLASSIC_TIFF = 2 ** 32 - 1
+
+
+class TiledTiffStream:
+    """Uncompressed, pixel interleaved, tiled GeoTIFF written front to back.
+
+    Uncompressed tiles have a fixed size, so every tile offset is known before
+    any pixel is rendered: the header and IFD go out first and the tiles follow
+    in row-major order as they are produced. That is the COG layout for a
+    single resolution image. Tiles marked absent are written sparse (offset and
+    byte count 0), readers see them as empty.
+    """
+
+    def __init__(self, width, height, count, dtype, tile_size, transform, epsg, geographic, present):
+        self.width = width
+        self.height = height
+        self.count = count
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.tile_size = tile_size
+        self.present = present
+        self.tile_bytes = tile_size * tile_size * count * self.dtype.itemsize
+
+        bits = [self.dtype.itemsize * 8] * count
+        entries = {
+            256: (LONG, [width]),
+            257: (LONG, [height]),
+            258: (SHORT, bits),
+            259: (SHORT, [1]),   # no compression
+            262: (SHORT, [1]),   # min is black
+            277: (SHORT, [count]),
+            284: (SHORT, [1]),   # chunky, bands interleaved per pixel
+            322: (LONG, [tile_size]),
+            323: (LONG, [tile_size]),
+            324: (LONG, [0] * len(present)),
+            325: (LONG, [0] * len(present)),
+            339: (SHORT, [sample_formats[self.dtype.kind]] * count),
+            33550: (DOUBLE, [transform.a, -transform.e, 0.0]),
+            33922: (DOUBLE, [0.0, 0.0, 0.0, transform.c, transform.f, 0.0]),
+            34735: (SHORT, self._geokeys(epsg, geographic)),
+        }
+        if count > 1:
+            entries[338] = (SHORT, [0] * (count - 1))
+
+        # IFD right after the 8 byte header, values that do not fit an entry follow it
+        ifd_size = 2 + 12 * len(entries) + 4
+        offset = 8 + ifd_size
+        value_offsets = {}
+        for tag in sorted(entries):
+            kind, values = entries[tag]
+            size = struct.calcsize(type_formats[kind]) * len(values)
+            if size > 4:
+                value_offsets[tag] = offset
+                offset += size + size % 2
+
+        tile_offsets = []
+        byte_counts = []
+        for tile_present in present:
+            tile_offsets.append(offset if tile_present else 0)
+            byte_counts.append(self.tile_bytes if tile_present else 0)
+            if tile_present:
+                offset += self.tile_bytes
+        if offset > MAX_CLASSIC_TIFF:
+            raise ValueError("output too large for a streamed tiff")
+        self.size = offset
+        entries[324] = (LONG, tile_offsets)
+        entries[325] = (LONG, byte_counts)
+
+        ifd = struct.pack("<H", len(entries))
+        values_area = b""
+        for tag in sorted(entries):
+            kind, values = entries[tag]
+            packed = struct.pack("<" + type_formats[kind] * len(values), *values)
+            if tag in value_offsets:
+                ifd += struct.pack("<HHII", tag, kind, len(values), value_offsets[tag])
+                values_area += packed + b"\0" * (len(packed) % 2)
+            else:
+                ifd += struct.pack("<HHI", tag, kind, len(values)) + packed.ljust(4, b"\0")
+        ifd += struct.pack("<I", 0)
+        self._header = b"II*\0" + struct.pack("<I", 8) + ifd + values_area
+
+    def _geokeys(self, epsg, geographic):
+        keys = [
+            (1024, 2 if geographic else 1),   # model type
+            (1025, 1),                        # raster type, pixel is area
+            (2048 if geographic else 3072, epsg),
+        ]
+        directory = [1, 1, 0, len(keys)]
+        for key, value in keys:
+            directory += [key, 0, 1, value]
+        return directory
+
+    @staticmethod
+    def fits(width, height, count, dtype, tile_size):
+        tiles = -(-width // tile_size) * -(-height // tile_size)
+        return tiles * tile_size * tile_size * count * np.dtype(dtype).itemsize < MAX_CLASSIC_TIFF - 2 ** 20
+
+    def header(self) -> bytes:
+        return self._header
+
+    def tile(self, data) -> bytes:
+        """Bytes of one tile from a (count, height, width) block, edge blocks are padded to the full tile."""
+        tile = np.zeros((self.tile_size, self.tile_size, self.count), dtype=self.dtype)
+        tile[:data.shape[1], :data.shape[2], :] = np.moveaxis(data, 0, -1)
+        return tile.tobytes()
@@ -0,0 +1,82 @@
+import time
+import asyncio
+
+# close enough to process start, main imports this first
+PROCESS_START = time.time()
+
+
+class WarmupState:
+    def __init__(self):
+        self.status = "starting"
+        self.error = None
+        self.import_seconds = None
+        self.warmup_seconds = None
+        self.cold_start_seconds = None
+        self.first_request_seconds = None
+        self.task = None
+
+    def report(self):
+        return {
+            "status": self.status,
+            "error": self.error,
+            "import_seconds": self.import_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "cold_start_seconds": self.cold_start_seconds,
+            "first_request_seconds": self.first_request_seconds,
+        }
+
+
+state = WarmupState()
+
+
+def warm_up():
+    """Load the heavy modules and initialise GDAL and PROJ once, so the first request does not pay for it."""
+    start = time.time()
+    state.status = "warming"
+    try:
+        import numpy
+        import rasterio
+        from rasterio.crs import CRS
+        from rasterio.warp import transform_bounds
+
+        import process
+        import search
+        import evalscript
+        import products
+        state.import_seconds = time.time() - start
+
+        with rasterio.Env() as env:
+            # entering the environment registers the GDAL drivers
+            drivers = env.drivers()
+            for driver in ("GTiff", "JP2OpenJPEG"):
+                if driver not in drivers:
+                    print("warning: GDAL driver", driver, "is not available")
+            # opens proj.db and builds a UTM to lat/lon operation
+            transform_bounds(CRS.from_epsg(32633), CRS.from_epsg(4326), 500000, 0, 600000, 100000)
+
+        from cache import get_cache
+        get_cache()
+    except Exception as err:
+        state.status = "failed"
+        state.error = repr(err)
+        raise
+
+    now = time.time()
+    state.warmup_seconds = now - start
+    state.cold_start_seconds = now - PROCESS_START
+    state.status = "ready"
+    print("warm up took", state.warmup_seconds, "seconds, ready", state.cold_start_seconds, "seconds after start")
+
+
+def start():
+    state.task = asyncio.get_event_loop().run_in_executor(None, warm_up)
+
+
+async def wait_ready():
+    await state.task
+
+
+def record_request(started: float):
+    if state.first_request_seconds is None:
+        state.first_request_seconds = time.time() - started
+        print("first request took", state.first_request_seconds, "seconds")